@@ -5,11 +5,12 @@ MongoDB helper functions ready to use in your backend code.
 Import and use these functions in your API endpoints for database operations.
 """
 
-from pymongo import MongoClient
+from motor.motor_asyncio import AsyncIOMotorClient
+import asyncio
 from datetime import datetime, timezone
 import os
 from dotenv import load_dotenv
-from typing import Union
+from typing import List, Tuple, Union
 from pydantic import BaseModel
 
 # Load environment variables from .env file
@@ -22,11 +23,51 @@ database_url = os.getenv("DATABASE_URL")
 database_name = os.getenv("DATABASE_NAME")
 
 if database_url and database_name:
-    _client = MongoClient(database_url)
+    # One shared client per process. Each uvicorn worker gets its own pool, so
+    # the defaults split a per-host budget of ~100 connections (10 kept warm)
+    # across WEB_CONCURRENCY workers; the env vars override the per-worker size.
+    _workers = max(1, int(os.getenv("WEB_CONCURRENCY", 1)))
+    _client = AsyncIOMotorClient(
+        database_url,
+        maxPoolSize=int(os.getenv("DATABASE_MAX_POOL_SIZE", max(10, 100 // _workers))),
+        minPoolSize=int(os.getenv("DATABASE_MIN_POOL_SIZE", 10 // _workers)),
+        waitQueueTimeoutMS=2000,
+        serverSelectionTimeoutMS=5000,
+        retryWrites=True,
+    )
     db = _client[database_name]
 
+_indexes_ready = False
+
+async def ensure_indexes():
+    """Create the indexes the API queries rely on (no-op if they already exist)
+
+    The unique email index cannot be built while the user collection holds
+    duplicate registered emails; those must be merged or removed first.
+    """
+    global _indexes_ready
+    if db is None:
+        return
+    # Only registered accounts must be unique; guest docs may share an email
+    await db.user.create_index(
+        "email", unique=True, name="email_registered_unique",
+        partialFilterExpression={"is_guest": False},
+    )
+    await db.userinput.create_index("user_id")
+    await db.analysissummary.create_index([("user_id", 1), ("_id", -1)])
+    _indexes_ready = True
+
+def indexes_ready() -> bool:
+    """Whether ensure_indexes has completed in this process"""
+    return _indexes_ready
+
+def close_database():
+    """Close the shared client and release pooled connections"""
+    if _client is not None:
+        _client.close()
+
 # Helper functions for common database operations
-def create_document(collection_name: str, data: Union[BaseModel, dict]):
+async def create_document(collection_name: str, data: Union[BaseModel, dict]):
     """Insert a single document with timestamp"""
     if db is None:
         raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
@@ -40,16 +81,56 @@ def create_document(collection_name: str, data: Union[BaseModel, dict]):
     data_dict['created_at'] = datetime.now(timezone.utc)
     data_dict['updated_at'] = datetime.now(timezone.utc)
 
-    result = db[collection_name].insert_one(data_dict)
+    result = await db[collection_name].insert_one(data_dict)
     return str(result.inserted_id)
 
-def get_documents(collection_name: str, filter_dict: dict = None, limit: int = None):
+async def update_document(collection_name: str, filter_dict: dict, update_data: dict):
+    """Set fields on the first matching document and bump its timestamp"""
+    if db is None:
+        raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+
+    result = await db[collection_name].update_one(
+        filter_dict, {"$set": {**update_data, 'updated_at': datetime.now(timezone.utc)}}
+    )
+    return result.modified_count
+
+async def create_documents_bulk(items: List[Tuple[str, Union[BaseModel, dict]]]):
+    """Insert several documents with timestamps, one insert_many per collection"""
+    if db is None:
+        raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+
+    now = datetime.now(timezone.utc)
+    grouped = {}
+    for collection_name, data in items:
+        data_dict = data.model_dump() if isinstance(data, BaseModel) else data.copy()
+        data_dict['created_at'] = now
+        data_dict['updated_at'] = now
+        grouped.setdefault(collection_name, []).append(data_dict)
+
+    # Collections are independent, so issue their inserts concurrently
+    results = await asyncio.gather(*(
+        db[name].insert_many(docs, ordered=False) for name, docs in grouped.items()
+    ))
+    return {
+        name: [str(_id) for _id in result.inserted_ids]
+        for name, result in zip(grouped, results)
+    }
+
+async def get_documents(collection_name: str, filter_dict: dict = None, limit: int = None, projection: dict = None):
     """Get documents from collection"""
     if db is None:
         raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
     
-    cursor = db[collection_name].find(filter_dict or {})
+    cursor = db[collection_name].find(filter_dict or {}, projection)
     if limit:
         cursor = cursor.limit(limit)
     
-    return list(cursor)
+    return await cursor.to_list(length=limit)
+
+async def aggregate_documents(collection_name: str, pipeline: list, limit: int = None):
+    """Run an aggregation pipeline on a collection"""
+    if db is None:
+        raise Exception("Database not available. Check DATABASE_URL and DATABASE_NAME environment variables.")
+
+    cursor = db[collection_name].aggregate(pipeline)
+    return await cursor.to_list(length=limit)
@@ -1,202 +1,385 @@
 import os
-from fastapi import FastAPI, HTTPException
+import asyncio
+import re
+import hmac
+import logging
+import orjson
+from argon2 import PasswordHasher
+from argon2.exceptions import InvalidHashError, VerificationError
+from cachetools import TTLCache
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel, EmailStr
-from typing import Optional, Dict, Any
-from database import db, create_document, get_documents
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel, TypeAdapter, ValidationError, field_validator
+from pymongo.errors import DuplicateKeyError
+from typing import Optional, Dict, Any, Tuple
+from database import (
+    db, aggregate_documents, close_database, create_document,
+    create_documents_bulk, ensure_indexes, get_documents, indexes_ready, update_document
+)
 from schemas import (
     User, UserInput, AnalysisSummary, LookmaxxingDetail,
     PhysiquePlan, StylingPlan, GlowUpPlan
 )
 
-app = FastAPI(title="RUVA API")
+logger = logging.getLogger(__name__)
+
+# Serialized /summary bodies keyed by user_id. /workflow/run can only
+# invalidate the cache of its own process, so it is enabled only when the app
+# runs as a single worker (WEB_CONCURRENCY, as read by uvicorn and database.py).
+_SUMMARY_CACHE_ENABLED = int(os.getenv("WEB_CONCURRENCY", 1)) <= 1
+_SUMMARY_CACHE: TTLCache = TTLCache(maxsize=10_000, ttl=60)
+# Bumped by /workflow/run after each insert; a /summary miss only stores its
+# body if no run completed while it was reading from the database. Entries
+# only matter while a body could be cached, so they share the cache's TTL.
+_SUMMARY_GENERATION: TTLCache = TTLCache(maxsize=10_000, ttl=60)
+
+# /test is polled by health checks; env is fixed for the process lifetime and
+# collections change rarely, so neither is re-read on every call
+_ENV_DB_URL_SET = bool(os.getenv("DATABASE_URL"))
+_ENV_DB_NAME_SET = bool(os.getenv("DATABASE_NAME"))
+_COLLECTIONS_CACHE: TTLCache = TTLCache(maxsize=1, ttl=30)
+
+
+async def _ensure_indexes_with_retry():
+    # Keep the app serving (and /test reporting) while Mongo is unreachable or
+    # the index build fails; signup stays unavailable until this succeeds
+    delay = 1
+    while True:
+        try:
+            await ensure_indexes()
+            return
+        except Exception as e:
+            logger.warning("Could not create database indexes, retrying in %ss: %s", delay, e)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 60)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    index_task = asyncio.create_task(_ensure_indexes_with_retry())
+    yield
+    index_task.cancel()
+    close_database()
+
+
+app = FastAPI(title="RUVA API", default_response_class=ORJSONResponse, lifespan=lifespan)
 
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],
+    allow_origins=[
+        origin.strip()
+        for origin in os.getenv("FRONTEND_ORIGIN", "https://app.ruva.example").split(",")
+        if origin.strip()
+    ],
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    max_age=86400,
 )
 
 
 @app.get("/")
-def root():
+async def root():
     return {"name": "RUVA", "status": "ok"}
 
 
 # Auth models
-class SignupRequest(BaseModel):
-    email: EmailStr
+_EMAIL_RE = re.compile(r"[^@\s]+@[^@\s]+\.[^@\s]+")
+
+
+class _EmailRequest(BaseModel):
+    email: str
+
+    @field_validator("email")
+    @classmethod
+    def check_email(cls, v: str) -> str:
+        # Cheap syntax check for the auth hot path; User keeps EmailStr
+        if not _EMAIL_RE.fullmatch(v):
+            raise ValueError("value is not a valid email address")
+        # Match EmailStr normalisation so lookups agree with stored emails
+        local, _, domain = v.rpartition("@")
+        return f"{local}@{domain.lower()}"
+
+
+class SignupRequest(_EmailRequest):
     password: str
 
 
-class LoginRequest(BaseModel):
-    email: EmailStr
+class LoginRequest(_EmailRequest):
     password: str
 
 
-class GuestLoginRequest(BaseModel):
-    email: EmailStr
+class GuestLoginRequest(_EmailRequest):
+    pass
+
+
+def _body_errors(e: ValidationError) -> list:
+    return [{**err, "loc": ("body", *err["loc"])} for err in e.errors(include_url=False)]
 
 
 # -------- Authentication (minimal, not production-grade) --------
+_PH = PasswordHasher(time_cost=2, memory_cost=19456, parallelism=1)
+# Stored as password_hash for guest accounts; never a valid argon2 hash
+_GUEST_PASSWORD_MARKER = "guest"
+
+
+def _verify_password(password_hash: str, password: str) -> bool:
+    # Accounts created before argon2 hashing stored "hash:<password>"
+    if password_hash.startswith("hash:"):
+        return hmac.compare_digest(password_hash.encode(), f"hash:{password}".encode())
+    try:
+        return _PH.verify(password_hash, password)
+    except (VerificationError, InvalidHashError):
+        return False
+
+
+def _new_user(email: str, password_hash: str, is_guest: bool) -> User:
+    # User keeps EmailStr, which is stricter than the request-model regex;
+    # report its rejections as a 422 like any other invalid body
+    try:
+        return User(email=email, password_hash=password_hash, is_guest=is_guest)
+    except ValidationError as e:
+        raise RequestValidationError(_body_errors(e))
+
+
+def _needs_rehash(password_hash: str) -> bool:
+    # Legacy rows hold the plaintext password and must always be upgraded
+    return password_hash.startswith("hash:") or _PH.check_needs_rehash(password_hash)
+
+
 @app.post("/auth/signup")
-def signup(payload: SignupRequest):
+async def signup(payload: SignupRequest):
+    # Uniqueness is enforced only by the email index, so wait until it exists
+    if db is not None and not indexes_ready():
+        raise HTTPException(status_code=503, detail="Signup temporarily unavailable")
+    # Validate before hashing; argon2 is CPU-bound, so keep it off the event loop
+    user = _new_user(payload.email, "", is_guest=False)
+    password_hash = await run_in_threadpool(_PH.hash, payload.password)
+    user = user.model_copy(update={"password_hash": password_hash})
+    # The unique index on user.email rejects duplicates without a pre-check
     try:
-        existing = get_documents("user", {"email": payload.email}, limit=1)
+        user_id = await create_document("user", user)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=409, detail="Email already exists")
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
-    if existing:
-        raise HTTPException(status_code=409, detail="Email already exists")
-
-    user = User(email=payload.email, password_hash=f"hash:{payload.password}", is_guest=False)
-    user_id = create_document("user", user)
     return {"user_id": user_id, "email": payload.email}
 
 
 @app.post("/auth/login")
-def login(payload: LoginRequest):
+async def login(payload: LoginRequest):
     try:
-        users = get_documents("user", {"email": payload.email}, limit=1)
+        users = await get_documents("user", {"email": payload.email, "is_guest": False}, limit=1)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     if not users:
         raise HTTPException(status_code=404, detail="User not found")
     user = users[0]
-    if user.get("password_hash") != f"hash:{payload.password}":
+    password_hash = user.get("password_hash") or _GUEST_PASSWORD_MARKER
+    if password_hash == _GUEST_PASSWORD_MARKER or not await run_in_threadpool(
+        _verify_password, password_hash, payload.password
+    ):
         raise HTTPException(status_code=401, detail="Invalid credentials")
+    if _needs_rehash(password_hash):
+        # Login still succeeds if the upgrade fails; it is retried next time
+        try:
+            new_hash = await run_in_threadpool(_PH.hash, payload.password)
+            await update_document("user", {"_id": user["_id"]}, {"password_hash": new_hash})
+        except Exception as e:
+            logger.warning("Could not upgrade password hash: %s", e)
     return {"user_id": str(user.get("_id")), "email": user.get("email")}
 
 
 @app.post("/auth/guest")
-def guest_login(payload: GuestLoginRequest):
-    user = User(email=payload.email, password_hash="guest", is_guest=True)
-    user_id = create_document("user", user)
+async def guest_login(payload: GuestLoginRequest):
+    user = _new_user(payload.email, _GUEST_PASSWORD_MARKER, is_guest=True)
+    user_id = await create_document("user", user)
     return {"user_id": user_id, "email": payload.email, "guest": True}
 
 
 # -------- User Input --------
-@app.post("/input")
-def save_user_input(data: UserInput):
-    doc_id = create_document("userinput", data)
+_USERINPUT_ADAPTER = TypeAdapter(UserInput)
+
+
+# Body is parsed and validated in one pydantic-core pass from the raw bytes;
+# the schema is declared explicitly since FastAPI no longer binds the model
+@app.post("/input", openapi_extra={
+    "requestBody": {
+        "required": True,
+        "content": {"application/json": {"schema": UserInput.model_json_schema()}},
+    },
+})
+async def save_user_input(request: Request):
+    try:
+        data = _USERINPUT_ADAPTER.validate_json(await request.body())
+    except ValidationError as e:
+        raise RequestValidationError(_body_errors(e))
+    doc_id = await create_document("userinput", data)
     return {"input_id": doc_id}
 
 
 # -------- AI Workflow stubs (rule-based placeholders) --------
-def make_face_analysis(data: Dict[str, Any]) -> LookmaxxingDetail:
-    return LookmaxxingDetail(
-        user_id=data["user_id"],
-        face_shape="oval",
-        strong_features=["defined jawline"],
-        weak_features=["under-eye puffiness"],
-        grooming=["weekly exfoliation", "SPF 50 daily"],
-        hairstyle=["medium length textured crop"],
-        accessories=["thin metal frames", "minimalist studs"],
-    )
+# Plan content does not depend on the input yet, so the payloads are built
+# once at import and each request only splices in its user_id. Values are
+# tuples because every payload shares them; orjson and BSON encode them as
+# arrays.
+_FACE_TEMPLATE: Dict[str, Any] = {
+    "face_shape": "oval",
+    "strong_features": ("defined jawline",),
+    "weak_features": ("under-eye puffiness",),
+    "grooming": ("weekly exfoliation", "SPF 50 daily"),
+    "hairstyle": ("medium length textured crop",),
+    "accessories": ("thin metal frames", "minimalist studs"),
+}
+
+_PHYS_TEMPLATE: Dict[str, Any] = {
+    "body_type": "athletic",
+    "workout_7_day": (
+        "Push strength",
+        "Pull strength",
+        "Legs + core",
+        "Active recovery (walk + mobility)",
+        "Upper hypertrophy",
+        "Lower hypertrophy",
+        "Rest + stretch",
+    ),
+    "posture_cues": ("neck long", "ribs down", "glutes on"),
+    "diet_notes": ("high protein", "2L water", "500 kcal deficit (if fat loss)"),
+}
+
+_STYLE_TEMPLATE: Dict[str, Any] = {
+    "daily_outfits": ("monochrome black smart-casual", "cream knit + tapered chinos"),
+    "colours": ("cream", "black", "light gold"),
+    "wardrobe_essentials": ("white sneakers", "dark denim", "oxford shirt"),
+    "hairstyle_synergy": ("texture complements jawline",),
+}
+
+_GLOW_TEMPLATE: Dict[str, Any] = {
+    "week_by_week": (
+        "Week 1: skin baseline + haircut",
+        "Week 2: posture daily 10m + wardrobe audit",
+        "Week 3: gym routine locked",
+        "Week 4: social refresh (bio/photos)",
+        "Weeks 5-12: progressions + photos",
+    ),
+}
+
+
+# Set PLANNERS_USE_INPUT once the planners derive plans from the stored user
+# input; until then /workflow/run skips fetching it. Only UserInput fields are
+# ever decoded.
+_PLANNERS_USE_INPUT = os.getenv("PLANNERS_USE_INPUT", "").lower() in ("1", "true", "yes")
+_USERINPUT_PROJECTION: Dict[str, int] = {"_id": 0, **{name: 1 for name in UserInput.model_fields}}
+
+
+def _summary_fields(face: Dict[str, Any], phys: Dict[str, Any], style: Dict[str, Any]) -> Dict[str, str]:
+    return {
+        "face_summary": f"Face shape {face['face_shape']}; groom: {', '.join(face['grooming'])}",
+        "physique_summary": f"Body {phys['body_type']}; posture: {', '.join(phys['posture_cues'])}",
+        "style_summary": f"Colours: {', '.join(style['colours'])}",
+        "outfit_summary": f"Outfits: {', '.join(style['daily_outfits'])}",
+    }
 
 
-def make_physique_plan(data: Dict[str, Any]) -> PhysiquePlan:
-    return PhysiquePlan(
-        user_id=data["user_id"],
-        body_type="athletic",
-        workout_7_day=[
-            "Push strength",
-            "Pull strength",
-            "Legs + core",
-            "Active recovery (walk + mobility)",
-            "Upper hypertrophy",
-            "Lower hypertrophy",
-            "Rest + stretch",
-        ],
-        posture_cues=["neck long", "ribs down", "glutes on"],
-        diet_notes=["high protein", "2L water", "500 kcal deficit (if fat loss)"]
-    )
+# The summary text is a pure function of the static templates above
+_SUMMARY_TEMPLATE: Dict[str, str] = _summary_fields(_FACE_TEMPLATE, _PHYS_TEMPLATE, _STYLE_TEMPLATE)
 
 
-def make_styling_plan(data: Dict[str, Any]) -> StylingPlan:
-    return StylingPlan(
-        user_id=data["user_id"],
-        daily_outfits=["monochrome black smart-casual", "cream knit + tapered chinos"],
-        colours=["cream", "black", "light gold"],
-        wardrobe_essentials=["white sneakers", "dark denim", "oxford shirt"],
-        hairstyle_synergy=["texture complements jawline"]
+def _build_all(user_id: str) -> Tuple[Dict[str, Any], ...]:
+    """Return the (face, physique, styling, glow, summary) payloads for a user"""
+    return (
+        {"user_id": user_id, **_FACE_TEMPLATE},
+        {"user_id": user_id, **_PHYS_TEMPLATE},
+        {"user_id": user_id, **_STYLE_TEMPLATE},
+        {"user_id": user_id, **_GLOW_TEMPLATE},
+        {"user_id": user_id, **_SUMMARY_TEMPLATE},
     )
 
 
-def make_glow_up(data: Dict[str, Any]) -> GlowUpPlan:
-    return GlowUpPlan(
-        user_id=data["user_id"],
-        week_by_week=[
-            "Week 1: skin baseline + haircut",
-            "Week 2: posture daily 10m + wardrobe audit",
-            "Week 3: gym routine locked",
-            "Week 4: social refresh (bio/photos)",
-            "Weeks 5-12: progressions + photos",
-        ],
-    )
+class WorkflowRequest(BaseModel):
+    user_id: str
 
 
-def make_summary(face: LookmaxxingDetail, phys: PhysiquePlan, style: StylingPlan) -> AnalysisSummary:
-    return AnalysisSummary(
-        user_id=face.user_id,
-        face_summary=f"Face shape {face.face_shape}; groom: {', '.join(face.grooming)}",
-        physique_summary=f"Body {phys.body_type}; posture: {', '.join(phys.posture_cues)}",
-        style_summary=f"Colours: {', '.join(style.colours)}",
-        outfit_summary=f"Outfits: {', '.join(style.daily_outfits)}",
-    )
+class WorkflowResponse(BaseModel):
+    summary: AnalysisSummary
+    face: LookmaxxingDetail
+    physique: PhysiquePlan
+    styling: StylingPlan
+    glow: GlowUpPlan
 
 
-class WorkflowRequest(BaseModel):
-    user_id: str
+@app.post("/workflow/run", response_model=WorkflowResponse)
+async def run_workflow(req: WorkflowRequest):
+    base = {"user_id": req.user_id}
+    if _PLANNERS_USE_INPUT:
+        try:
+            inputs = await get_documents(
+                "userinput", {"user_id": req.user_id}, limit=1, projection=_USERINPUT_PROJECTION
+            )
+        except Exception as e:
+            raise HTTPException(status_code=500, detail=str(e))
+        if inputs:
+            base = inputs[0]
 
+    face, phys, style, glow, summary = _build_all(base["user_id"])
 
-@app.post("/workflow/run")
-def run_workflow(req: WorkflowRequest):
+    # Persist summaries
     try:
-        inputs = get_documents("userinput", {"user_id": req.user_id}, limit=1)
+        await create_documents_bulk([
+            ("lookmaxxingdetail", face),
+            ("physiqueplan", phys),
+            ("stylingplan", style),
+            ("glowupplan", glow),
+            ("analysissummary", summary),
+        ])
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
-    base = inputs[0] if inputs else {"user_id": req.user_id}
-
-    face = make_face_analysis(base)
-    phys = make_physique_plan(base)
-    style = make_styling_plan(base)
-    glow = make_glow_up(base)
-    summary = make_summary(face, phys, style)
-
-    # Persist summaries
-    create_document("lookmaxxingdetail", face)
-    create_document("physiqueplan", phys)
-    create_document("stylingplan", style)
-    create_document("glowupplan", glow)
-    create_document("analysissummary", summary)
+    _SUMMARY_GENERATION[req.user_id] = _SUMMARY_GENERATION.get(req.user_id, 0) + 1
+    _SUMMARY_CACHE.pop(req.user_id, None)
 
-    return {
-        "summary": summary.model_dump(),
-        "face": face.model_dump(),
-        "physique": phys.model_dump(),
-        "styling": style.model_dump(),
-        "glow": glow.model_dump(),
-    }
+    # Dict order matches WorkflowResponse, so this encodes the same JSON
+    # without instantiating any models
+    body = orjson.dumps({
+        "summary": summary,
+        "face": face,
+        "physique": phys,
+        "styling": style,
+        "glow": glow,
+    })
+    return Response(content=body, media_type="application/json")
 
 
 @app.get("/summary/{user_id}")
-def get_latest_summary(user_id: str):
+async def get_latest_summary(user_id: str):
+    cached = _SUMMARY_CACHE.get(user_id)
+    if cached is not None:
+        return Response(content=cached, media_type="application/json")
+
+    generation = _SUMMARY_GENERATION.get(user_id, 0)
     try:
-        docs = get_documents("analysissummary", {"user_id": user_id}, limit=1)
+        # Stringify _id server-side so the document is JSON-ready as decoded
+        docs = await aggregate_documents("analysissummary", [
+            {"$match": {"user_id": user_id}},
+            {"$sort": {"_id": -1}},
+            {"$limit": 1},
+            {"$addFields": {"_id": {"$toString": "$_id"}}},
+        ])
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
     if not docs:
         raise HTTPException(status_code=404, detail="No summary yet")
-    doc = docs[0]
-    # Convert ObjectId to str safely
-    doc["_id"] = str(doc.get("_id"))
-    return doc
+    body = orjson.dumps(docs[0])
+    if _SUMMARY_CACHE_ENABLED and _SUMMARY_GENERATION.get(user_id, 0) == generation:
+        _SUMMARY_CACHE[user_id] = body
+    return Response(content=body, media_type="application/json")
 
 
 @app.get("/test")
-def test_database():
+async def test_database():
     response = {
         "backend": "✅ Running",
         "database": "❌ Not Available",
@@ -213,8 +396,11 @@ def test_database():
             response["database_name"] = db.name if hasattr(db, 'name') else "✅ Connected"
             response["connection_status"] = "Connected"
             try:
-                collections = db.list_collection_names()
-                response["collections"] = collections[:10]
+                collections = _COLLECTIONS_CACHE.get("names")
+                if collections is None:
+                    collections = (await db.list_collection_names())[:10]
+                    _COLLECTIONS_CACHE["names"] = collections
+                response["collections"] = collections
                 response["database"] = "✅ Connected & Working"
             except Exception as e:
                 response["database"] = f"⚠️  Connected but Error: {str(e)[:50]}"
@@ -224,8 +410,8 @@ def test_database():
         response["database"] = f"❌ Error: {str(e)[:50]}"
 
     # Env
-    response["database_url"] = "✅ Set" if os.getenv("DATABASE_URL") else "❌ Not Set"
-    response["database_name"] = "✅ Set" if os.getenv("DATABASE_NAME") else "❌ Not Set"
+    response["database_url"] = "✅ Set" if _ENV_DB_URL_SET else "❌ Not Set"
+    response["database_name"] = "✅ Set" if _ENV_DB_NAME_SET else "❌ Not Set"
 
     return response
 
@@ -233,4 +419,15 @@ def test_database():
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 8000))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    workers = int(os.getenv("WEB_CONCURRENCY", os.cpu_count() or 2))
+    # Worker processes inherit this and size their Mongo pools from it
+    os.environ["WEB_CONCURRENCY"] = str(workers)
+    # Import-string form is required for workers > 1. uvicorn picks uvloop
+    # and httptools by default when they are installed.
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=port,
+        workers=workers,
+        log_level="warning",
+    )
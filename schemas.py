@@ -3,7 +3,8 @@ Database Schemas for RUVA
 
 Each Pydantic model maps to a MongoDB collection (lowercased class name).
 """
-from typing import Optional, List, Literal
+from dataclasses import dataclass
+from typing import Optional, List, Literal, Tuple
 from pydantic import BaseModel, Field, EmailStr
 
 
@@ -63,7 +64,15 @@ class GlowUpPlan(BaseModel):
     week_by_week: List[str] = []
 
 
-# Simple pricing schema (reference only)
-class Pricing(BaseModel):
+# Simple pricing schema (reference only); fixed rows, so no Pydantic validation
+@dataclass(slots=True, frozen=True)
+class Pricing:
     tier: Literal["weekly", "monthly", "yearly"]
     price: int
+
+
+PRICING: Tuple[Pricing, ...] = (
+    Pricing("weekly", 5),
+    Pricing("monthly", 15),
+    Pricing("yearly", 120),
+)